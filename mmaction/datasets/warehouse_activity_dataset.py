@@ -4,14 +4,18 @@ This software is proprietary and confidential. Unauthorized copying,
 distribution, modification, or use is strictly prohibited. This software
 is provided "as is," without warranty of any kind.
 """
+import hashlib
 import os
 import os.path as osp
-from collections import defaultdict
+import sys
+from concurrent.futures import ThreadPoolExecutor
 from typing import Callable, List, Optional, Tuple, Union
 
 import numpy as np
 import pandas as pd
-from mmengine.fileio import exists, list_from_file, load
+import torch
+from mmengine.fileio import dump, exists, load
+from mmengine.logging import MMLogger
 
 from mmaction.evaluation import read_labelmap
 from mmaction.registry import DATASETS
@@ -105,7 +109,32 @@ class WarehouseActivityDataset(AVADataset):
             Otherwise by second. Defaults to 30.
         multilabel (bool): Determines whether it is a multilabel recognition
             task. Defaults to True.
+        use_ann_cache (bool): Whether to cache the parsed annotations in a
+            pickle file next to ``ann_file``. The cache is keyed on the
+            options affecting the parsed result, including the fps table,
+            and rebuilt whenever ``ann_file`` or ``fps_file`` is newer than
+            it. Note that it does not track changes of the frame folders. If
+            pyarrow is installed, a parquet copy of ``ann_file`` is saved as
+            well, and read instead of ``ann_file`` as long as it is newer
+            than ``ann_file``. The packed proposals are also saved next to
+            ``proposal_file`` and memory-mapped afterwards, so that all the
+            dataloader workers share them through the page cache.
+            Defaults to False.
+        derive_shot_info_from_ann (bool): Whether to estimate the shot info
+            of each video from its annotated timestamps instead of scanning
+            its frame folder. It assumes the frames are extracted from
+            ``timestamp_start`` on, starting at ``start_index``, and end with
+            the last annotated timestamp. Only used if ``use_frames`` is True.
+            Defaults to False.
     """
+
+    # Attributes set by ``load_data_list`` which are stored in the cache.
+    _CACHED_ATTRS = ('shot_info_dict', 'per_sample_weights', 'gt_bboxes',
+                     'gt_labels', 'entity_ids')
+    # Bump it whenever the cached attributes or their layout change, so that
+    # the caches written by older versions are rebuilt.
+    _ANN_CACHE_VERSION = 1
+
     def __init__(self,
                  ann_file: str,
                  pipeline: List[Union[ConfigType, Callable]],
@@ -129,19 +158,28 @@ class WarehouseActivityDataset(AVADataset):
                  multilabel: bool = True,
                  class_weights: Optional[dict] = None,
                  augment_labels: Optional[bool] = False,
+                 use_ann_cache: bool = False,
+                 derive_shot_info_from_ann: bool = False,
                  **kwargs) -> None:
+        self.fps_file = fps_file
         if fps_file is not None:
-            fps_mapping = pd.read_csv(fps_file)
+            fps_mapping = pd.read_csv(
+                fps_file,
+                usecols=['image_name', 'fps'],
+                dtype={
+                    'image_name': str,
+                    'fps': np.float64
+                })
             self._FPS = self.create_fps_mapping(fps_mapping)
             self._FPS['default'] = fps
         else:
             self._FPS = fps  # Keep this as standard
 
         self.augment_labels = augment_labels
+        self.use_ann_cache = use_ann_cache
+        self.derive_shot_info_from_ann = derive_shot_info_from_ann
         self.class_weights = class_weights
         self.per_sample_weights = None
-        if class_weights:
-            self.per_sample_weights = []
 
         self.custom_classes = custom_classes
         if custom_classes is not None:
@@ -151,6 +189,15 @@ class WarehouseActivityDataset(AVADataset):
             assert set(custom_classes).issubset(class_whitelist)
 
             self.custom_classes = list([0] + custom_classes)
+
+        # class weights indexed by the label index, i.e. the position in
+        # ``custom_classes`` if it is given
+        self._cls_weight_vec = None
+        if class_weights:
+            class_ids = self.custom_classes or range(num_classes)
+            self._cls_weight_vec = np.array(
+                [class_weights.get(c, 1.) for c in class_ids],
+                dtype=np.float64)
         self.exclude_file = exclude_file
         self.label_file = label_file
         self.proposal_file = proposal_file
@@ -176,15 +223,79 @@ class WarehouseActivityDataset(AVADataset):
             **kwargs)
 
         if self.proposal_file is not None:
-            self.proposals = load(self.proposal_file)
+            self.proposals, self.proposal_inds = self._load_proposals()
         else:
-            self.proposals = None
+            self.proposals, self.proposal_inds = None, None
+
+    def _load_proposals(self) -> Tuple[np.ndarray, dict]:
+        """Load the packed proposals, memory-mapped if they are cached.
+
+        The cached arrays are only used with ``use_ann_cache`` and a local
+        ``proposal_file``. Otherwise the proposal file is loaded through the
+        mmengine file backends as is.
+
+        Returns:
+            np.ndarray: All proposals, in shape (M, 4) or (M, 5).
+            dict: The ``(start, end)`` rows of each ``img_key``.
+        """
+        if not self.use_ann_cache or not osp.isfile(self.proposal_file):
+            return self._pack_proposals(load(self.proposal_file))
+
+        array_file = f'{self.proposal_file}.npy'
+        inds_file = f'{self.proposal_file}.idx.json'
+        proposal_mtime = osp.getmtime(self.proposal_file)
+        if osp.exists(array_file) and osp.exists(inds_file) and \
+                osp.getmtime(array_file) >= proposal_mtime and \
+                osp.getmtime(inds_file) >= proposal_mtime:
+            return np.load(array_file, mmap_mode='r'), load(inds_file)
+
+        proposals, proposal_inds = self._pack_proposals(
+            load(self.proposal_file))
+        # write to temporary files first so that concurrent ranks never
+        # read partially written ones
+        tmp_suffix = f'.{os.getpid()}.tmp'
+        with open(array_file + tmp_suffix, 'wb') as f:
+            np.save(f, proposals)
+        dump(proposal_inds, inds_file + tmp_suffix, file_format='json')
+        os.replace(array_file + tmp_suffix, array_file)
+        os.replace(inds_file + tmp_suffix, inds_file)
+        return np.load(array_file, mmap_mode='r'), proposal_inds
+
+    @staticmethod
+    def _pack_proposals(proposals: dict) -> Tuple[np.ndarray, dict]:
+        """Concatenate the per ``img_key`` proposals into one array.
+
+        Args:
+            proposals (dict): Proposals of each ``img_key``, in shape (n, 4)
+                or (n, 5).
+
+        Returns:
+            np.ndarray: All proposals, in shape (M, 4) or (M, 5).
+            dict: The ``(start, end)`` rows of each ``img_key``.
+        """
+        proposal_inds = {}
+        chunks = []
+        cursor = 0
+        for img_key, img_proposals in proposals.items():
+            proposal_inds[img_key] = (cursor, cursor + len(img_proposals))
+            chunks.append(img_proposals)
+            cursor += len(img_proposals)
+        if not chunks:
+            return np.zeros((0, 5)), proposal_inds
+        all_proposals = np.concatenate(chunks, axis=0)
+        assert all_proposals.shape[-1] in [4, 5]
+        return all_proposals, proposal_inds
 
     def create_fps_mapping(self, fps_mapping_df: pd.DataFrame) -> dict:
-        fps_mapping = {}
-        for _, row in fps_mapping_df.iterrows():
-            fps_mapping[row['image_name']] = int(round(row['fps']))
-        return fps_mapping
+        fps = fps_mapping_df['fps'].round().astype(np.int64)
+        return dict(zip(fps_mapping_df['image_name'].tolist(), fps.tolist()))
+
+    def _get_fps(self, video_ids: pd.Series) -> List[int]:
+        """Look up the fps of each video in ``video_ids``."""
+        if not isinstance(self._FPS, dict):
+            return [self._FPS] * len(video_ids)
+        fps = video_ids.map(self._FPS).fillna(self._FPS['default'])
+        return fps.astype(np.int64).tolist()
 
     def _get_frame_id_from_filename(self, filename):
         """Extract frame id from filename."""
@@ -195,187 +306,341 @@ class WarehouseActivityDataset(AVADataset):
         target_dir = osp.join(img_root, video_id)
         return len(os.listdir(target_dir))
 
-    def _convert_one_hot_to_label(self, one_hot_labels):
-        """Convert one hot labels to label."""
-        return np.where(one_hot_labels == 1)[1]
-
-    def _duplicate_labels_within_frame(
-        self,
-        bboxes: np.ndarray,
-        labels: np.ndarray,
-        entity_ids: np.ndarray,
-    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
-        """Each label obj in labels is a list of actions performed
-        by the same person in the same frame.
-        Check if the labels needs to be augmented
-        by finding if there is a rare classes in the label
-        If there are multiple rare classes, we need to
-        find the maximum class weight aka. number of duplications
+    def _get_shot_range(self, target_dir: str) -> Tuple[int, int]:
+        """Get the first and last frame id of a frame folder."""
+        start, end = None, None
+        with os.scandir(target_dir) as it:
+            for entry in it:
+                frame_id = self._get_frame_id_from_filename(entry.name)
+                if start is None or frame_id < start:
+                    start = frame_id
+                if end is None or frame_id > end:
+                    end = frame_id
+        if start is None:
+            raise ValueError(f'No frames found in {target_dir}.')
+        return start, end
+
+    def _get_entity_weights(
+            self, labels: np.ndarray, label_entity: np.ndarray,
+            num_entities: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Get the maximum and the sum of the class weights of each entity.
+
+        Args:
+            labels (np.ndarray): One hot labels of the entities in shape
+                (num_entities, num_classes) if ``multilabel``, otherwise the
+                class indices of all labels grouped by entity.
+            label_entity (np.ndarray): The entity of each label in
+                ``labels`` if it is not one hot.
+            num_entities (int): The number of entities.
 
         Returns:
-            np.ndarray: Augmented bboxes
-            np.ndarray: Augmented labels
-            np.ndarray: Augmented entity_ids
+            np.ndarray: The maximum class weight of each entity.
+            np.ndarray: The sum of the class weights of each entity.
         """
-        # Augment rare labels by duplicating samples with the same label
-        aug_bboxes, aug_labels, aug_entity_ids = [], [], []
-        for i, label in enumerate(labels):
-            # Add original samples
-            aug_bboxes.append(bboxes[i])
-            aug_labels.append(labels[i])
-            aug_entity_ids.append(entity_ids[i])
-
+        if self.multilabel:
             # label is a one-hot vector [0, 0, 1, 1, 0, ...]
-            label_idxs = np.where(label == 1)[0]
-            weights = [self.class_weights[self.custom_classes[int(idx)]] for idx in label_idxs]
-
-            # Each label obj is a list of actions performed
-            # by the same person in the same frame.
-            # Check if the labels needs to be augmented
-            # by finding if there is a rare classes in the label
-            # If there are multiple rare classes, we need to
-            # find the maximum class weight aka. number of duplications
-            duplication_factor = int(max(max(weights), 1))
-
-            # If the class weight is less than 2, we don't need to augment
-            for _ in range(duplication_factor - 1):
-                aug_bboxes.append(bboxes[i])
-                aug_labels.append(labels[i])
-                aug_entity_ids.append(entity_ids[i])
-        return np.array(aug_bboxes), np.array(aug_labels), np.array(aug_entity_ids)
-
-    def build_shot_info_dict(self) -> dict:
-        """Compute shot info for a video."""
-        exists(self.ann_file)
-        df = pd.read_csv(self.ann_file)
-        try:
-            df.columns = [
-                "video_name",
-                "middle_frame_timestamp",
-                "x1",
-                "y1",
-                "x2",
-                "y2",
-                "class_label",
-                "person_id",
-                "obj_hash",
-                "created_by",
-                "created_at",
-            ]
-        except:
-            df.columns = [
-                "video_name",
-                "middle_frame_timestamp",
-                "x1",
-                "y1",
-                "x2",
-                "y2",
-                "class_label",
-                "person_id",
-            ]
+            weights = labels * self._cls_weight_vec
+            return weights.max(axis=1), weights.sum(axis=1)
+        weights = self._cls_weight_vec[labels]
+        max_weights = np.zeros(num_entities, dtype=np.float64)
+        np.maximum.at(max_weights, label_entity, weights)
+        sum_weights = np.bincount(
+            label_entity, weights=weights, minlength=num_entities)
+        return max_weights, sum_weights
+
+    def build_shot_info_dict(self, df: pd.DataFrame) -> dict:
+        """Compute shot info of the videos from their frame folders.
+
+        Args:
+            df (pd.DataFrame): The annotations read by ``_read_ann_file``.
+
+        Returns:
+            dict: The first and last frame id of each video.
+        """
         img_prefix = self.data_prefix['img']
-        shot_info_dict = {}
         unique_video_names = df['video_name'].unique()
-        for video_name in unique_video_names:
-            file_list = sorted(os.listdir(osp.join(img_prefix, video_name)))
-            first_file = file_list[0]
-            last_file = file_list[-1]
-            start = self._get_frame_id_from_filename(first_file)
-            end = self._get_frame_id_from_filename(last_file)
-            shot_info_dict[video_name] = (start, end)
+        # scandir releases the GIL while waiting on the file system
+        with ThreadPoolExecutor() as executor:
+            shot_ranges = executor.map(
+                self._get_shot_range,
+                [osp.join(img_prefix, name) for name in unique_video_names])
+            shot_info_dict = dict(zip(unique_video_names, shot_ranges))
         return shot_info_dict
 
-    def load_data_list(self) -> List[dict]:
-        """Load AVA annotations."""
+    def _derive_shot_info_dict(self, df: pd.DataFrame) -> dict:
+        """Estimate shot info of the videos from the annotated timestamps.
+
+        Args:
+            df (pd.DataFrame): The annotations read by ``_read_ann_file``.
+
+        Returns:
+            dict: The first and last frame id of each video.
+        """
+        last_timestamps = df.groupby(
+            'video_name', sort=False)['middle_frame_timestamp'].max()
+        fps = np.array(self._get_fps(last_timestamps.index.to_series()))
+        ends = self.start_index - 1 + fps * (
+            last_timestamps.to_numpy() - self.timestamp_start + 1)
+        return {
+            video_name: (self.start_index, int(end))
+            for video_name, end in zip(last_timestamps.index, ends)
+        }
+
+    def _maybe_load_parquet(self) -> Optional[pd.DataFrame]:
+        """Load the parquet copy of ``ann_file`` if it is up to date.
+
+        Returns:
+            pd.DataFrame, optional: The annotations, or None if there is no
+                fresh parquet file or pyarrow is not installed.
+        """
+        parquet_file = osp.splitext(self.ann_file)[0] + '.parquet'
+        if not osp.exists(parquet_file) or \
+                osp.getmtime(parquet_file) < osp.getmtime(self.ann_file):
+            return None
+        try:
+            import pyarrow.parquet as pq
+        except ImportError:
+            return None
+        return pq.read_table(parquet_file).to_pandas()
+
+    def _save_parquet(self, df: pd.DataFrame) -> None:
+        """Save a parquet copy of ``ann_file`` for faster loading."""
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            return
+        parquet_file = osp.splitext(self.ann_file)[0] + '.parquet'
+        tmp_file = f'{parquet_file}.{os.getpid()}.tmp'
+        df.to_parquet(tmp_file, compression='zstd', index=False)
+        os.replace(tmp_file, parquet_file)
+
+    def _read_ann_file(self) -> pd.DataFrame:
+        """Read the annotation csv into a typed DataFrame.
+
+        Only the first eight columns are used, so annotation files with the
+        extra ``obj_hash``, ``created_by`` and ``created_at`` columns are
+        supported as well. If ``use_ann_cache`` is set, a parquet copy next
+        to ``ann_file`` is preferred when it is up to date, and written
+        otherwise.
+        """
         exists(self.ann_file)
-        data_list = []
-        records_dict_by_img = defaultdict(list)
-        fin = list_from_file(self.ann_file)
-        self.shot_info_dict = self.build_shot_info_dict()
-        for line in fin:
-            line_split = line.strip().split(',')
-
-            label = int(line_split[6])
-            if self.custom_classes is not None:
-                if label not in self.custom_classes:
-                    continue
-                label = self.custom_classes.index(label)
-
-            video_id = line_split[0]
-            timestamp = int(line_split[1])  # count by second or frame.
-            img_key = f'{video_id},{timestamp:05d}'
-
-            entity_box = np.array(list(map(float, line_split[2:6])))
-            entity_id = int(line_split[7])
-            if self.use_frames:
-                # # Load shot info based on num files of target folder
-                shot_info = self.shot_info_dict[video_id]
-            # for video data, automatically get shot info when decoding
-            else:
-                shot_info = None
+        if self.use_ann_cache:
+            df = self._maybe_load_parquet()
+            if df is not None:
+                return df
+
+        df = pd.read_csv(
+            self.ann_file,
+            header=None,
+            usecols=range(8),
+            names=[
+                'video_name', 'middle_frame_timestamp', 'x1', 'y1', 'x2',
+                'y2', 'class_label', 'person_id'
+            ],
+            dtype={
+                'video_name': str,
+                'middle_frame_timestamp': np.int64,
+                'x1': np.float32,
+                'y1': np.float32,
+                'x2': np.float32,
+                'y2': np.float32,
+                'class_label': np.int64,
+                'person_id': np.int64,
+            })
+        if self.use_ann_cache:
+            self._save_parquet(df)
+        return df
+
+    def _ann_cache_file(self) -> str:
+        """Get the cache file path of the current annotation options."""
+        class_weights = self.class_weights
+        if class_weights:
+            class_weights = sorted(class_weights.items())
+        fps = self._FPS
+        if isinstance(fps, dict):
+            fps = sorted(fps.items())
+        options = (self._ANN_CACHE_VERSION, self.custom_classes,
+                   class_weights, fps, self.augment_labels, self.num_classes,
+                   self.multilabel, self.use_frames,
+                   self.derive_shot_info_from_ann, self.timestamp_start,
+                   self.start_index, self.data_prefix['img'])
+        digest = hashlib.md5(repr(options).encode()).hexdigest()[:8]
+        return f'{self.ann_file}.{digest}.cache.pkl'
 
-            self.shot_info_dict[video_id] = shot_info
+    def load_data_list(self) -> List[dict]:
+        """Load AVA annotations, from the cache file if possible."""
+        if not self.use_ann_cache:
+            return self._parse_data_list()
+
+        logger = MMLogger.get_current_instance()
+        cache_file = self._ann_cache_file()
+        source_files = [self.ann_file]
+        if self.fps_file is not None:
+            source_files.append(self.fps_file)
+        if osp.exists(cache_file) and osp.getmtime(cache_file) >= max(
+                osp.getmtime(file) for file in source_files):
+            logger.info(f'Load cached annotations from {cache_file}.')
+            cache = load(cache_file)
+            for attr in self._CACHED_ATTRS:
+                setattr(self, attr, cache[attr])
+            return cache['data_list']
+
+        data_list = self._parse_data_list()
+        cache = {attr: getattr(self, attr) for attr in self._CACHED_ATTRS}
+        cache['data_list'] = data_list
+        # dump to a temporary file first so that concurrent ranks never
+        # read a partially written cache
+        tmp_file = f'{cache_file}.{os.getpid()}.tmp'
+        dump(cache, tmp_file, file_format='pkl')
+        os.replace(tmp_file, cache_file)
+        logger.info(f'Save annotation cache to {cache_file}.')
+        return data_list
 
-            video_info = dict(
-                video_id=video_id,
-                timestamp=timestamp,
-                entity_box=entity_box,
-                label=label,
-                entity_id=entity_id,
-                shot_info=shot_info)
-            records_dict_by_img[img_key].append(video_info)
-
-        for img_key in records_dict_by_img:
-            video_id, timestamp = img_key.split(',')
-            bboxes, labels, entity_ids = self.parse_img_record(
-                records_dict_by_img[img_key])
-
-            if self.augment_labels and self.class_weights:
-                (
-                    aug_bboxes,
-                    aug_labels,
-                    aug_entity_ids,
-                ) = self._duplicate_labels_within_frame(bboxes, labels, entity_ids)
-                bboxes = aug_bboxes
-                labels = aug_labels
-                entity_ids = aug_entity_ids
-
-            ann = dict(
-                gt_bboxes=bboxes, gt_labels=labels, entity_ids=entity_ids)
+    def _parse_data_list(self) -> List[dict]:
+        """Parse AVA annotations from ``ann_file``."""
+        data_list = []
+        df = self._read_ann_file()
+        # for video data, automatically get shot info when decoding
+        if not self.use_frames:
+            self.shot_info_dict = {}
+        elif self.derive_shot_info_from_ann:
+            self.shot_info_dict = self._derive_shot_info_dict(df)
+        else:
+            self.shot_info_dict = self.build_shot_info_dict(df)
+        if self.custom_classes is not None:
+            df = df[df['class_label'].isin(self.custom_classes)]
+            df = df.reset_index(drop=True)
+            df['class_label'] = df['class_label'].map(
+                {c: i
+                 for i, c in enumerate(self.custom_classes)})
+        # count by second or frame.
+        df['img_key'] = df['video_name'] + ',' + \
+            df['middle_frame_timestamp'].map('{:05d}'.format)
+
+        # Stable sort the rows by img_key (in order of first appearance), so
+        # the rows of each frame are contiguous.
+        img_codes, img_keys = pd.factorize(df['img_key'])
+        order = np.argsort(img_codes, kind='stable')
+        df = df.iloc[order].reset_index(drop=True)
+        img_codes = img_codes[order]
+        num_imgs = len(img_keys)
+        img_counts = np.bincount(img_codes, minlength=num_imgs)
+        img_rows = np.cumsum(img_counts) - img_counts
+
+        # Merge the rows of the same entity at the same time, i.e. sharing
+        # the frame and the box. Entities are numbered in order of first
+        # appearance, so those of each frame are contiguous as well and keep
+        # the order of ``parse_img_record``.
+        row_entity = df.groupby(['img_key', 'x1', 'y1', 'x2', 'y2'],
+                                sort=False).ngroup().to_numpy()
+        _, entity_rows, entity_counts = np.unique(
+            row_entity, return_index=True, return_counts=True)
+        num_entities = len(entity_rows)
+        entity_img = img_codes[entity_rows]
+        # the labels of the rows, grouped by entity
+        label_order = np.argsort(row_entity, kind='stable')
+        flat_labels = df['class_label'].to_numpy()[label_order]
+        label_entity = row_entity[label_order]
+        # The format can be directly used by BCELossWithLogits
+        if self.multilabel:
+            gt_labels = np.zeros((num_entities, self.num_classes),
+                                 dtype=np.float32)
+            gt_labels[label_entity, flat_labels] = 1.
+        else:
+            # Like ``parse_img_record``, the class indices of the entities
+            # of a frame are stacked, so they need the same number of labels.
+            # They are stored flat and reshaped in ``get_data_info``.
+            img_entity_counts = np.bincount(entity_img, minlength=num_imgs)
+            img_first_entity = np.cumsum(img_entity_counts) - \
+                img_entity_counts
+            invalid = entity_counts != entity_counts[
+                img_first_entity[entity_img]]
+            if invalid.any():
+                img_key = img_keys[entity_img[np.argmax(invalid)]]
+                raise ValueError(f'The entities of {img_key} should have the '
+                                 'same number of labels when multilabel is '
+                                 'False.')
+            gt_labels = flat_labels
+
+        # Rare classes are augmented by duplicating the entities. If there
+        # are multiple rare classes, the maximum class weight is used as the
+        # number of duplications, and entities whose class weights are all
+        # less than 2 are not duplicated.
+        entity_inds = np.arange(num_entities)
+        if self.class_weights:
+            max_weights, sum_weights = self._get_entity_weights(
+                gt_labels, label_entity, num_entities)
+            if self.augment_labels:
+                repeats = np.maximum(max_weights, 1).astype(np.int64)
+                entity_inds = np.repeat(entity_inds, repeats)
+        entity_img = entity_img[entity_inds]
+
+        # The annotations of all frames are stored in master arrays, and each
+        # record only keeps the ``(start, end)`` rows of its frame, rather
+        # than holding three small ndarrays per record.
+        self.gt_bboxes = df[['x1', 'y1', 'x2', 'y2']].to_numpy(
+            dtype=np.float32)[entity_rows[entity_inds]]
+        self.entity_ids = df['person_id'].to_numpy()[entity_rows[
+            entity_inds]]
+        ann_counts = np.bincount(entity_img, minlength=num_imgs)
+        ann_ends = np.cumsum(ann_counts)
+        ann_starts = ann_ends - ann_counts
+        if self.multilabel:
+            self.gt_labels = gt_labels[entity_inds]
+            label_starts, label_ends = ann_starts, ann_ends
+        else:
+            label_counts = entity_counts[entity_inds]
+            label_offsets = np.cumsum(label_counts) - label_counts
+            entity_offsets = np.cumsum(entity_counts) - entity_counts
+            label_inds = np.arange(label_counts.sum()) + np.repeat(
+                entity_offsets[entity_inds] - label_offsets, label_counts)
+            self.gt_labels = gt_labels[label_inds]
+            img_label_counts = np.bincount(
+                entity_img, weights=label_counts,
+                minlength=num_imgs).astype(np.int64)
+            label_ends = np.cumsum(img_label_counts)
+            label_starts = label_ends - img_label_counts
+
+        # each record dict contains labels for all objects in frames
+        # which means it includes multiple labels
+        # The weights are calculated as the sum of the weights of all labels
+        if self.class_weights:
+            per_sample_weights = np.bincount(
+                entity_img,
+                weights=sum_weights[entity_inds],
+                minlength=num_imgs)
+            # a double tensor is used by WeightedRandomSampler as is
+            self.per_sample_weights = torch.from_numpy(per_sample_weights)
+
+        video_ids = df['video_name'].iloc[img_rows]
+        # look up the fps once per frame instead of once per record access
+        img_fps = self._get_fps(video_ids)
+        timestamps = df['middle_frame_timestamp'].to_numpy()[img_rows]
+        for (img_key, video_id, timestamp, fps, start, end, label_start,
+             label_end) in zip(img_keys, video_ids.tolist(),
+                               timestamps.tolist(), img_fps,
+                               ann_starts.tolist(), ann_ends.tolist(),
+                               label_starts.tolist(), label_ends.tolist()):
+            # share one string object among all frames of the same video
+            video_id = sys.intern(video_id)
             frame_dir = video_id
             if self.data_prefix['img'] is not None:
-                frame_dir = osp.join(self.data_prefix['img'], frame_dir)
+                frame_dir = sys.intern(
+                    osp.join(self.data_prefix['img'], frame_dir))
 
-            shot_info = self.shot_info_dict[video_id]
+            shot_info = self.shot_info_dict.get(video_id)
             video_info = dict(
                 frame_dir=frame_dir,
                 video_id=video_id,
-                timestamp=int(timestamp),
+                timestamp=timestamp,
                 img_key=img_key,
                 shot_info=shot_info,
-                fps=self._FPS.get(video_id, self._FPS['default']),
-                ann=ann)
+                fps=fps,
+                ann_inds=(start, end))
+            if not self.multilabel:
+                video_info['label_inds'] = (label_start, label_end)
             if not self.use_frames:
                 video_info['filename'] = video_info.pop('frame_dir')
-
-            # each record dict contains labels for all objects in frames
-            # which means it includes multiple labels
-            # The weights are calculated as the sum of the weights of all labels
-            converted_labels = self._convert_one_hot_to_label(labels)
-            original_labels = [self.custom_classes[label] for label in converted_labels]
-            # with open("sampling-weights-weighted.txt", "a") as f:
-            #     f.write(",".join([str(label) for label in original_labels]))
-            #     f.write("\n")
-
-            if self.class_weights:
-                # Also, the labels are the index of the class in the custom_classes list
-                # so we need to map them to the original labels
-                converted_weights = [self.class_weights[self.custom_classes[label]] for label in converted_labels]
-                total_weight = sum(converted_weights)
-                self.per_sample_weights.append(total_weight)
-            else:
-                converted_weights = [1.0] * len(converted_labels)
-                total_weight = len(converted_labels)
             data_list.append(video_info)
 
         return data_list
@@ -390,23 +655,24 @@ class WarehouseActivityDataset(AVADataset):
         data_info['timestamp_end'] = self.timestamp_end
 
         if self.proposals is not None:
-            if img_key not in self.proposals:
+            if img_key not in self.proposal_inds:
                 raise ValueError(f'{img_key} not in proposals.')
                 data_info['proposals'] = np.array([[0, 0, 1, 1]])
                 data_info['scores'] = np.array([1])
             else:
-                proposals = self.proposals[img_key]
-                assert proposals.shape[-1] in [4, 5]
+                start, end = self.proposal_inds[img_key]
+                proposals = self.proposals[start:end]
                 if proposals.shape[-1] == 5:
-                    thr = min(self.person_det_score_thr, max(proposals[:, 4]))
-                    positive_inds = (proposals[:, 4] >= thr)
-                    proposals = proposals[positive_inds]
+                    scores = proposals[:, 4]
+                    thr = min(self.person_det_score_thr, scores.max())
+                    proposals = proposals[scores >= thr]
                     proposals = proposals[:self.num_max_proposals]
                     data_info['proposals'] = proposals[:, :4]
                     data_info['scores'] = proposals[:, 4]
                 else:
-                    proposals = proposals[:self.num_max_proposals]
-                    data_info['proposals'] = proposals
+                    # copy out of the (possibly memory-mapped) packed array
+                    data_info['proposals'] = np.array(
+                        proposals[:self.num_max_proposals])
 
                 assert data_info['proposals'].max() <= 1 and \
                     data_info['proposals'].min() >= 0, \
@@ -414,9 +680,14 @@ class WarehouseActivityDataset(AVADataset):
                      f'{data_info["proposals"].max()}, min value '
                      f'{data_info["proposals"].min()}')
 
-        ann = data_info.pop('ann')
-        data_info['gt_bboxes'] = ann['gt_bboxes']
-        data_info['gt_labels'] = ann['gt_labels']
-        data_info['entity_ids'] = ann['entity_ids']
+        start, end = data_info.pop('ann_inds')
+        data_info['gt_bboxes'] = self.gt_bboxes[start:end]
+        if self.multilabel:
+            data_info['gt_labels'] = self.gt_labels[start:end]
+        else:
+            label_start, label_end = data_info.pop('label_inds')
+            data_info['gt_labels'] = self.gt_labels[
+                label_start:label_end].reshape(end - start, -1)
+        data_info['entity_ids'] = self.entity_ids[start:end]
 
         return data_info
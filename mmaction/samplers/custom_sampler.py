@@ -8,7 +8,6 @@ from collections.abc import Sized
 from typing import Iterator, Optional
 
 import torch
-from torch.utils.data import WeightedRandomSampler
 from mmaction.registry import DATA_SAMPLERS
 from mmengine.dataset.sampler import DefaultSampler
 
@@ -25,6 +24,8 @@ class WeightedSampler(DefaultSampler):
 
         # Get per sample weights required by WeightedRandomSampler
         self.weights = self.dataset.per_sample_weights
+        if self.weights is not None:
+            self.weights = torch.as_tensor(self.weights, dtype=torch.double)
         self.replacement = replacement
 
     def __iter__(self) -> Iterator[int]:
@@ -36,12 +37,12 @@ class WeightedSampler(DefaultSampler):
             if self.weights is None:
                 indices = torch.randperm(len(self.dataset), generator=g).tolist()
             else:
-                indices = list(WeightedRandomSampler(
-                    weights=self.weights,
-                    num_samples=len(self.dataset),
-                    replacement=self.replacement,
-                    generator=g,
-                ))
+                # same draw as WeightedRandomSampler, without iterating it
+                indices = torch.multinomial(
+                    self.weights,
+                    len(self.dataset),
+                    self.replacement,
+                    generator=g).tolist()
 
         else:
             indices = torch.arange(len(self.dataset)).tolist()
@@ -0,0 +1,288 @@
+"""COPYRIGHT (C) [2024], CompScience, Inc.
+
+This software is proprietary and confidential. Unauthorized copying,
+distribution, modification, or use is strictly prohibited. This software
+is provided "as is," without warranty of any kind.
+"""
+import os
+import os.path as osp
+import shutil
+
+import mmengine
+import numpy as np
+import pandas as pd
+import pytest
+import torch
+from numpy.testing import assert_array_almost_equal, assert_array_equal
+
+from mmaction.datasets import WarehouseActivityDataset
+from mmaction.utils import register_all_modules
+
+
+class TestWarehouseActivityDataset:
+
+    @classmethod
+    def setup_class(cls):
+        cls.data_prefix = osp.normpath(
+            osp.join(osp.dirname(__file__), './../data', 'ava_dataset'))
+        cls.label_file = osp.join(cls.data_prefix, 'action_list.txt')
+        cls.ann_file = osp.join(cls.data_prefix, 'warehouse_sample.csv')
+        cls.custom_classes = [12, 17, 79]
+        cls.class_weights = {12: 1, 17: 2, 79: 3}
+        cls.img_keys = ['vidA,00902', 'vidA,00903', 'vidB,00902']
+        cls.bboxes = [
+            np.array([[0.1, 0.1, 0.5, 0.5], [0.6, 0.2, 0.9, 0.8]]),
+            np.array([[0.1, 0.1, 0.5, 0.5]]),
+            np.array([[0.2, 0.3, 0.4, 0.7]])
+        ]
+        # label indices in ``[0] + custom_classes``; class 80 is dropped
+        cls.labels = [
+            np.array([[0, 1, 1, 0], [0, 1, 0, 1]]),
+            np.array([[0, 1, 0, 0]]),
+            np.array([[0, 0, 1, 0]])
+        ]
+        cls.entity_ids = [np.array([0, 1]), np.array([0]), np.array([2])]
+
+    @staticmethod
+    def dump_fps_file(fps_file, fps_dict):
+        with open(fps_file, 'w') as f:
+            f.write('image_name,fps\n')
+            for video_name, fps in fps_dict.items():
+                f.write(f'{video_name},{fps}\n')
+
+    def build_dataset(self, ann_file=None, **kwargs):
+        register_all_modules()
+        kwargs.setdefault('data_prefix', {'img': self.data_prefix})
+        kwargs.setdefault('use_frames', False)
+        return WarehouseActivityDataset(
+            ann_file or self.ann_file, [],
+            label_file=self.label_file,
+            custom_classes=self.custom_classes,
+            num_classes=4,
+            **kwargs)
+
+    def test_load_data_list(self):
+        dataset = self.build_dataset()
+        assert len(dataset) == 3
+        for i in range(3):
+            data_info = dataset.get_data_info(i)
+            assert data_info['img_key'] == self.img_keys[i]
+            assert data_info['fps'] == 30
+            assert data_info['shot_info'] is None
+            assert_array_almost_equal(data_info['gt_bboxes'], self.bboxes[i])
+            assert_array_equal(data_info['gt_labels'], self.labels[i])
+            assert_array_equal(data_info['entity_ids'], self.entity_ids[i])
+        # the records only keep the rows of their frame in the master arrays
+        assert len(dataset.gt_bboxes) == len(dataset.gt_labels) == 4
+
+    def test_per_sample_weights(self):
+        dataset = self.build_dataset(class_weights=self.class_weights)
+        # the sum of the class weights of all labels in each frame
+        assert_array_almost_equal(dataset.per_sample_weights.numpy(),
+                                  [7, 1, 2])
+        # used by WeightedSampler as is
+        assert isinstance(dataset.per_sample_weights, torch.Tensor)
+        assert dataset.per_sample_weights.dtype == torch.double
+
+        dataset = self.build_dataset()
+        assert dataset.per_sample_weights is None
+
+    def test_augment_labels(self):
+        dataset = self.build_dataset(
+            class_weights=self.class_weights, augment_labels=True)
+        # each entity is repeated by the max class weight of its labels
+        repeats = [np.array([2, 3]), np.array([1]), np.array([2])]
+        for i in range(3):
+            data_info = dataset.get_data_info(i)
+            assert_array_almost_equal(
+                data_info['gt_bboxes'],
+                np.repeat(self.bboxes[i], repeats[i], axis=0))
+            assert_array_equal(data_info['gt_labels'],
+                               np.repeat(self.labels[i], repeats[i], axis=0))
+            assert_array_equal(
+                data_info['entity_ids'],
+                np.repeat(self.entity_ids[i], repeats[i], axis=0))
+        assert_array_almost_equal(dataset.per_sample_weights.numpy(),
+                                  [18, 1, 4])
+
+    def test_single_label(self, tmp_path):
+        # the number of labels only has to match within a frame
+        dataset = self.build_dataset(multilabel=False)
+        target_labels = [np.array([[1, 2], [3, 1]]), np.array([[1]]),
+                         np.array([[2]])]
+        for i in range(3):
+            data_info = dataset.get_data_info(i)
+            assert_array_equal(data_info['gt_labels'], target_labels[i])
+            assert_array_equal(data_info['entity_ids'], self.entity_ids[i])
+
+        ann_file = osp.join(tmp_path, 'invalid.csv')
+        with open(ann_file, 'w') as f:
+            f.write('vidA,0902,0.1,0.1,0.5,0.5,12,0\n'
+                    'vidA,0902,0.1,0.1,0.5,0.5,17,0\n'
+                    'vidA,0902,0.6,0.2,0.9,0.8,79,1\n')
+        with pytest.raises(ValueError, match='vidA,00902'):
+            self.build_dataset(ann_file, multilabel=False)
+
+    def test_ann_cache(self, tmp_path):
+        ann_file = osp.join(tmp_path, 'warehouse_sample.csv')
+        shutil.copy(self.ann_file, ann_file)
+        datasets = [
+            self.build_dataset(
+                ann_file,
+                class_weights=self.class_weights,
+                augment_labels=True,
+                use_ann_cache=True) for _ in range(2)
+        ]
+        assert len(list(tmp_path.glob('*.cache.pkl'))) == 1
+        for i in range(3):
+            data_infos = [dataset.get_data_info(i) for dataset in datasets]
+            for key in ['img_key', 'fps', 'shot_info']:
+                assert data_infos[0][key] == data_infos[1][key]
+            for key in ['gt_bboxes', 'gt_labels', 'entity_ids']:
+                assert_array_equal(data_infos[0][key], data_infos[1][key])
+        assert_array_equal(datasets[0].per_sample_weights,
+                           datasets[1].per_sample_weights)
+
+        # another config does not hit the same cache file
+        self.build_dataset(ann_file, use_ann_cache=True)
+        assert len(list(tmp_path.glob('*.cache.pkl'))) == 2
+
+    def test_ann_cache_version(self, tmp_path, monkeypatch):
+        ann_file = osp.join(tmp_path, 'warehouse_sample.csv')
+        shutil.copy(self.ann_file, ann_file)
+        # a cache of an older layout, without the master arrays
+        with monkeypatch.context() as m:
+            m.setattr(WarehouseActivityDataset, '_ANN_CACHE_VERSION', 0)
+            self.build_dataset(ann_file, use_ann_cache=True)
+        cache_file, = tmp_path.glob('*.cache.pkl')
+        cache = mmengine.load(cache_file)
+        del cache['gt_bboxes']
+        mmengine.dump(cache, cache_file, file_format='pkl')
+
+        # it is not loaded by the current version
+        dataset = self.build_dataset(ann_file, use_ann_cache=True)
+        assert len(list(tmp_path.glob('*.cache.pkl'))) == 2
+        assert_array_almost_equal(
+            dataset.get_data_info(0)['gt_bboxes'], self.bboxes[0])
+
+    def test_parquet_copy(self, tmp_path, monkeypatch):
+        pytest.importorskip('pyarrow')
+        ann_file = osp.join(tmp_path, 'warehouse_sample.csv')
+        shutil.copy(self.ann_file, ann_file)
+        parquet_file = osp.join(tmp_path, 'warehouse_sample.parquet')
+        target = self.build_dataset(ann_file, use_ann_cache=True)
+        assert osp.exists(parquet_file)
+
+        def read_csv(*args, **kwargs):
+            raise AssertionError('The parquet copy should be read.')
+
+        # other options miss the pickle cache but hit the parquet copy
+        with monkeypatch.context() as m:
+            m.setattr(pd, 'read_csv', read_csv)
+            dataset = self.build_dataset(
+                ann_file, use_ann_cache=True, augment_labels=True)
+        assert len(dataset) == len(target)
+        for i in range(len(dataset)):
+            data_info = dataset.get_data_info(i)
+            target_info = target.get_data_info(i)
+            assert data_info['img_key'] == target_info['img_key']
+            for key in ['gt_bboxes', 'gt_labels', 'entity_ids']:
+                assert_array_equal(data_info[key], target_info[key])
+
+        # the parquet copy is ignored without use_ann_cache, even if it is
+        # newer than ann_file
+        with open(ann_file, 'w') as f:
+            f.write('vidA,0902,0.1,0.1,0.5,0.5,12,0\n')
+        mtime = osp.getmtime(parquet_file) - 10
+        os.utime(ann_file, (mtime, mtime))
+        assert len(self.build_dataset(ann_file)) == 1
+
+    @pytest.mark.parametrize('use_ann_cache', [False, True])
+    def test_proposals(self, tmp_path, use_ann_cache):
+        proposal_file = osp.join(tmp_path, 'proposals.pkl')
+        mmengine.dump(
+            {
+                'vidA,00902':
+                np.array([[0.1, 0.1, 0.5, 0.5, 0.95],
+                          [0.6, 0.2, 0.9, 0.8, 0.3]]),
+                'vidA,00903':
+                np.array([[0.1, 0.1, 0.5, 0.5, 0.5]]),
+                'vidB,00902':
+                np.array([[0.2, 0.3, 0.4, 0.7, 0.99]])
+            }, proposal_file)
+        # keep the cache files out of the test data folder
+        ann_file = osp.join(tmp_path, 'warehouse_sample.csv')
+        shutil.copy(self.ann_file, ann_file)
+        dataset = self.build_dataset(
+            ann_file,
+            proposal_file=proposal_file,
+            use_ann_cache=use_ann_cache)
+        # the cached proposals are memory-mapped from a sidecar file
+        assert osp.exists(proposal_file + '.npy') == use_ann_cache
+        assert isinstance(dataset.proposals, np.memmap) == use_ann_cache
+        assert dataset.proposals.shape == (4, 5)
+        assert dataset.proposals.dtype == np.float64
+
+        data_info = dataset.get_data_info(0)
+        assert_array_equal(data_info['proposals'], [[0.1, 0.1, 0.5, 0.5]])
+        assert_array_equal(data_info['scores'], [0.95])
+        assert data_info['proposals'].dtype == np.float64
+        data_info = dataset.get_data_info(2)
+        assert_array_equal(data_info['proposals'], [[0.2, 0.3, 0.4, 0.7]])
+        assert_array_equal(data_info['scores'], [0.99])
+        # fall back to the best proposal if none passes the threshold
+        data_info = dataset.get_data_info(1)
+        assert_array_equal(data_info['proposals'], [[0.1, 0.1, 0.5, 0.5]])
+        assert_array_equal(data_info['scores'], [0.5])
+
+    def test_fps_file(self, tmp_path):
+        fps_file = osp.join(tmp_path, 'fps.csv')
+        self.dump_fps_file(fps_file, {'vidA': 24.6, 'vidB': 14.4})
+        dataset = self.build_dataset(fps_file=fps_file)
+        # the fps of each video is rounded to the nearest integer
+        assert [dataset.get_data_info(i)['fps'] for i in range(3)] == \
+            [25, 25, 14]
+
+        # videos missing from fps_file use the default fps
+        self.dump_fps_file(fps_file, {'vidA': 24.6})
+        dataset = self.build_dataset(fps_file=fps_file, fps=15)
+        assert [dataset.get_data_info(i)['fps'] for i in range(3)] == \
+            [25, 25, 15]
+
+    def test_derive_shot_info_from_ann(self, tmp_path):
+        fps_file = osp.join(tmp_path, 'fps.csv')
+        self.dump_fps_file(fps_file, {'vidA': 25, 'vidB': 14})
+        dataset = self.build_dataset(
+            fps_file=fps_file,
+            use_frames=True,
+            derive_shot_info_from_ann=True,
+            timestamp_start=900,
+            start_index=1)
+        # the frames run from ``timestamp_start`` to the end of the last
+        # annotated second, i.e. 903 for vidA and 902 for vidB
+        assert dataset.shot_info_dict == {'vidA': (1, 100), 'vidB': (1, 42)}
+        assert [dataset.get_data_info(i)['shot_info'] for i in range(3)] == \
+            [(1, 100), (1, 100), (1, 42)]
+
+    def test_build_shot_info_dict(self, tmp_path):
+        # frame ids are not zero-padded, so they are not ordered by name
+        frame_names = {
+            'vidA': ['img_9.jpg', 'img_10.jpg', 'img_120.jpg'],
+            'vidB': ['img_41.jpg', 'img_3.jpg']
+        }
+        for video_name, names in frame_names.items():
+            (tmp_path / video_name).mkdir()
+            for name in names:
+                (tmp_path / video_name / name).touch()
+        dataset = self.build_dataset(
+            data_prefix={'img': str(tmp_path)}, use_frames=True)
+        assert dataset.shot_info_dict == {'vidA': (9, 120), 'vidB': (3, 41)}
+        data_info = dataset.get_data_info(2)
+        assert data_info['frame_dir'] == osp.join(tmp_path, 'vidB')
+        assert data_info['shot_info'] == (3, 41)
+
+        for name in frame_names['vidB']:
+            (tmp_path / 'vidB' / name).unlink()
+        with pytest.raises(ValueError, match='No frames found'):
+            self.build_dataset(
+                data_prefix={'img': str(tmp_path)}, use_frames=True)
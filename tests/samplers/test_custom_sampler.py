@@ -0,0 +1,53 @@
+"""COPYRIGHT (C) [2024], CompScience, Inc.
+
+This software is proprietary and confidential. Unauthorized copying,
+distribution, modification, or use is strictly prohibited. This software
+is provided "as is," without warranty of any kind.
+"""
+import torch
+from torch.utils.data import WeightedRandomSampler
+
+from mmaction.samplers import WeightedSampler
+
+
+class DummyDataset:
+
+    def __init__(self, per_sample_weights, length=10):
+        self.per_sample_weights = per_sample_weights
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+
+def test_weighted_sampler():
+    weights = torch.tensor([1., 5., 0., 2., 0.5, 3., 1., 0., 4., 2.],
+                           dtype=torch.double)
+    dataset = DummyDataset(weights)
+    sampler = WeightedSampler(dataset, seed=7)
+    for epoch in range(3):
+        sampler.set_epoch(epoch)
+        g = torch.Generator()
+        g.manual_seed(7 + epoch)
+        # same draw as WeightedRandomSampler with the same generator seed
+        target = list(
+            WeightedRandomSampler(
+                weights=weights,
+                num_samples=len(dataset),
+                replacement=True,
+                generator=g))
+        indices = list(sampler)
+        assert indices == target
+        assert all(weights[idx] > 0 for idx in indices)
+
+    # a list of weights is supported as well
+    sampler = WeightedSampler(DummyDataset(weights.tolist()), seed=7)
+    sampler.set_epoch(2)
+    assert list(sampler) == indices
+
+    # fall back to a plain shuffle without weights
+    sampler = WeightedSampler(DummyDataset(None), seed=7)
+    assert sorted(sampler) == list(range(10))
+
+    sampler = WeightedSampler(dataset, shuffle=False)
+    assert list(sampler) == list(range(10))